@@ -1,31 +1,178 @@
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi import FastAPI, HTTPException, Query, BackgroundTasks
+from fastapi.responses import RedirectResponse, JSONResponse, Response
 import httpx
-import secrets
+import orjson
 import hashlib
+import hmac
+import base64
+import bcrypt
 from datetime import datetime, timedelta
 from typing import Optional, Dict, List
 import os
 import json
+import time
+import functools
+import itertools
+import urllib.parse
+from collections import deque
+from dataclasses import dataclass, field
+from contextlib import asynccontextmanager
+
+class OrjsonResponse(JSONResponse):
+    """JSON response rendered with orjson"""
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the shared HTTP client on startup and close it on shutdown"""
+    global HTTP_CLIENT
+    get_http_client()
+    yield
+    if HTTP_CLIENT is not None:
+        await HTTP_CLIENT.aclose()
+        HTTP_CLIENT = None
 
 app = FastAPI(
     title="Universal AI API",
     description="Multi-service AI API with credit limits and admin controls",
-    version="3.1.0"
+    version="3.1.0",
+    default_response_class=OrjsonResponse,
+    lifespan=lifespan
 )
 
+@dataclass(slots=True)
+class KeyRecord:
+    """Stored state for a single API key"""
+    id: int
+    key: str
+    name: str
+    created_at: datetime
+    is_active: bool
+    daily_limit: int
+    credits: int
+    last_reset: datetime
+    expires_at: datetime
+    total_requests: int = 0
+    daily_requests: int = 0
+    last_used: Optional[datetime] = None
+    # Day ordinal of last_reset, kept so rollover checks are an int compare
+    last_reset_ordinal: int = field(init=False)
+
+    def __post_init__(self):
+        self.last_reset_ordinal = self.last_reset.toordinal()
+
+class RequestLogStore:
+    """Ring buffer of request logs kept as one deque per field"""
+    __slots__ = ('ids', 'api_keys', 'endpoints', 'prompts', 'response_times', 'credits_used', 'created_at')
+
+    def __init__(self, maxlen: int):
+        for name in self.__slots__:
+            setattr(self, name, deque(maxlen=maxlen))
+
+    def append(self, log_id: int, api_key: str, endpoint: str, prompt: Optional[str],
+               response_time: Optional[float], credits_used: int, created_at: datetime):
+        self.ids.append(log_id)
+        self.api_keys.append(api_key)
+        self.endpoints.append(endpoint)
+        self.prompts.append(prompt)
+        self.response_times.append(response_time)
+        self.credits_used.append(credits_used)
+        self.created_at.append(created_at)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self):
+        """Yield entries oldest first as dicts"""
+        for log_id, api_key, endpoint, prompt, response_time, credits_used, created_at in zip(
+            self.ids, self.api_keys, self.endpoints, self.prompts,
+            self.response_times, self.credits_used, self.created_at
+        ):
+            yield {
+                'id': log_id,
+                'api_key': api_key,
+                'endpoint': endpoint,
+                'prompt': prompt,
+                'response_time': response_time,
+                'credits_used': credits_used,
+                'created_at': created_at
+            }
+
 # In-memory storage for serverless compatibility
 API_KEYS_STORAGE = {}
 ADMIN_USERS_STORAGE = {}
-REQUEST_LOGS_STORAGE = []
+# Keep only last 100 logs to prevent memory issues; oldest entries drop off automatically
+REQUEST_LOGS_STORAGE = RequestLogStore(maxlen=100)
+# Monotonic log ids, so ids stay unique after old entries are evicted
+_LOG_ID = itertools.count(1)
+# Per-key (window_start, count) so a flood of requests can't churn the log buffer;
+# after the first _LOG_BURST entries in a window only every _LOG_SAMPLE-th is kept
+_LOG_RATE: Dict[str, tuple] = {}
+_LOG_WINDOW = 1.0
+_LOG_BURST = 10
+_LOG_SAMPLE = 10
+
+# Upstream URL templates
+_FFINFO_TMPL = "https://danger-info-alpha.vercel.app/accinfo?uid={}&key=MK_DEVELOPER"
+_IMG_TMPL = "https://image.pollinations.ai/prompt/{}?width={}&height={}&nologo=true"
+_VOICE_TMPL = "https://api.murf.ai/api/v1/speech/synthesize/stream?text={}&voice=en-US-Standard-B&format=mp3&style=neutral&spokenPacing=medium"
+_QR_TMPL = "https://api.qrserver.com/v1/create-qr-code/?size=200x200&data={}&format=svg"
+_VIDEO_TMPL = "https://image.pollinations.ai/prompt/{}?width=512&height=512&nologo=true&seed=1&model=black-forest-labs/flux"
+_NUM_TMPL = "https://nixonsmmapi.s77134867.workers.dev/?mobile={}"
+
+# Root endpoint catalog never changes, so serialize it once
+_ROOT_BODY = orjson.dumps({
+    "message": "Universal AI API",
+    "version": "3.1.0",
+    "status": "running",
+    "endpoints": {
+        "/image": "Generate images (2 credits)",
+        "/video": "Generate videos (2 credits)",
+        "/voice": "Generate voice (1 credit)",
+        "/qr": "Generate QR codes (1 credit)",
+        "/num": "Number service (5 credits)",
+        "/ffinfo": "Info redirect (1 credit)",
+        "/health": "Health check",
+        "/admin/*": "Admin endpoints"
+    }
+})
+
+# Serialized /health body as (built_at, body); replaced as a whole so readers never see a half-update
+_HEALTH_CACHE = (float("-inf"), b"")
+_HEALTH_TTL = 1.0
+
+# Precomputed bcrypt hashes (cost 12) so cold starts don't pay for hashpw
+_DEFAULT_ADMIN_HASH = b"$2b$12$uSLSgVjpALmFdezizuvQmOOszHPn6btIVx74EoeLx04JersYZEeU6"
+# Fixed hash checked against for unknown usernames so lookups take the same time
+_DUMMY_ADMIN_HASH = b"$2b$12$n3prQYy1Z0sUL5N0Q/PnCul5NJKfX4P4fl/kGwgSdQk4G5sp4nINa"
+
+# Shared HTTP client so upstream connections are kept alive between requests
+HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the shared HTTP client, creating it if startup did not run"""
+    global HTTP_CLIENT
+    if HTTP_CLIENT is None or HTTP_CLIENT.is_closed:
+        HTTP_CLIENT = httpx.AsyncClient(
+            timeout=30.0,
+            limits=httpx.Limits(max_keepalive_connections=50, max_connections=100),
+            http2=True
+        )
+    return HTTP_CLIENT
 
 # Generate a simpler API key that's more reliable in serverless
 def generate_api_key():
     """Generate a simple API key for serverless environment"""
-    import time
-    timestamp = str(int(time.time()))
-    random_part = secrets.token_urlsafe(16)
-    return f"api_{timestamp}_{random_part}"
+    random_part = base64.urlsafe_b64encode(os.urandom(16)).rstrip(b"=")
+    return (b"api_%d_%s" % (time.time_ns() // 1_000_000_000, random_part)).decode()
+
+_quote = urllib.parse.quote
+
+@functools.lru_cache(maxsize=1024)
+def _qquote(s: str) -> str:
+    """URL-quote user input, caching repeated prompts"""
+    return _quote(s)
 
 # Initialize storage with default admin - keep it simple for serverless
 def init_storage():
@@ -33,27 +180,23 @@ def init_storage():
     global API_KEYS_STORAGE, ADMIN_USERS_STORAGE, REQUEST_LOGS_STORAGE
     
     try:
-        # Default admin with simple password
-        password_hash = hashlib.sha256("mk123".encode()).hexdigest()
-        ADMIN_USERS_STORAGE['mk'] = password_hash
+        # Default admin with simple password (bcrypt of "mk123", cost 12)
+        ADMIN_USERS_STORAGE['mk'] = _DEFAULT_ADMIN_HASH
         
         # Create a default API key for testing
         try:
             default_key = generate_api_key()
-            API_KEYS_STORAGE[default_key] = {
-                'id': 1,
-                'key': default_key,
-                'name': 'Test Key',
-                'created_at': datetime.utcnow(),
-                'is_active': True,
-                'total_requests': 0,
-                'daily_requests': 0,
-                'daily_limit': 30,
-                'credits': 50,
-                'last_reset': datetime.utcnow(),
-                'last_used': None,
-                'expires_at': datetime.utcnow() + timedelta(days=365)
-            }
+            API_KEYS_STORAGE[default_key] = KeyRecord(
+                id=1,
+                key=default_key,
+                name='Test Key',
+                created_at=datetime.utcnow(),
+                is_active=True,
+                daily_limit=30,
+                credits=50,
+                last_reset=datetime.utcnow(),
+                expires_at=datetime.utcnow() + timedelta(days=365)
+            )
             print(f"✅ Default API key created: {default_key[:8]}...")
         except Exception as e:
             print(f"Warning: Could not create default API key: {e}")
@@ -70,313 +213,283 @@ except Exception as e:
 def verify_admin(username: str, password: str) -> bool:
     """Verify admin credentials"""
     try:
-        if username in ADMIN_USERS_STORAGE:
-            stored_hash = ADMIN_USERS_STORAGE[username]
-            return hashlib.sha256(password.encode()).hexdigest() == stored_hash
+        if username not in ADMIN_USERS_STORAGE:
+            bcrypt.checkpw(password.encode(), _DUMMY_ADMIN_HASH)
+            return False
+
+        stored_hash = ADMIN_USERS_STORAGE[username]
+        if isinstance(stored_hash, bytes):
+            return bcrypt.checkpw(password.encode(), stored_hash)
+
+        # Legacy SHA-256 hex digests
+        return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored_hash)
     except Exception:
         pass
     return False
 
-def check_credits(api_key: str, credits_needed: int = 0) -> bool:
-    """Check if user has enough credits"""
-    try:
-        if api_key not in API_KEYS_STORAGE:
-            return False
-        
-        key_data = API_KEYS_STORAGE[api_key]
-        if not key_data['is_active']:
-            return False
-        
-        return key_data['credits'] >= credits_needed
-    except Exception:
-        return False
+def _make_check(credits_needed: int):
+    """Build a function that authorizes a key for a fixed credit cost"""
+    unit = "credit" if credits_needed == 1 else "credits"
+    insufficient = f"Insufficient credits. This service costs {credits_needed} {unit}."
 
-def use_credits(api_key: str, credits_used: int):
-    """Deduct credits from user's balance"""
-    try:
-        if api_key in API_KEYS_STORAGE:
-            API_KEYS_STORAGE[api_key]['credits'] -= credits_used
-    except Exception:
-        pass
+    def check(api_key: str) -> KeyRecord:
+        """Return the key's record if it is valid and can pay the service cost"""
+        key_data = API_KEYS_STORAGE.get(api_key)
+        if key_data is None:
+            raise HTTPException(status_code=401, detail="Invalid API key")
+
+        if not key_data.is_active or key_data.credits < credits_needed:
+            raise HTTPException(status_code=402, detail=insufficient)
+
+        return key_data
+
+    check.__name__ = f"check_{credits_needed}"
+    return check
+
+# One check per service cost; callers deduct the cost with no await after the check,
+# so concurrent requests on the event loop can't overspend
+check_1 = _make_check(1)
+check_2 = _make_check(2)
+check_5 = _make_check(5)
 
 def log_request(api_key: str, endpoint: str, prompt: str = None, response_time: float = None, credits_used: int = 0):
     """Log API request for analytics"""
     try:
-        REQUEST_LOGS_STORAGE.append({
-            'id': len(REQUEST_LOGS_STORAGE) + 1,
-            'api_key': api_key,
-            'endpoint': endpoint,
-            'prompt': prompt,
-            'response_time': response_time,
-            'credits_used': credits_used,
-            'created_at': datetime.utcnow()
-        })
-        
-        # Keep only last 100 logs to prevent memory issues
-        if len(REQUEST_LOGS_STORAGE) > 100:
-            REQUEST_LOGS_STORAGE.pop(0)
+        now = time.monotonic()
+        window_start, count = _LOG_RATE.get(api_key, (now, 0))
+        if now - window_start > _LOG_WINDOW:
+            window_start, count = now, 0
+        count += 1
+        _LOG_RATE[api_key] = (window_start, count)
+        if count > _LOG_BURST and count % _LOG_SAMPLE:
+            return
+
+        REQUEST_LOGS_STORAGE.append(
+            next(_LOG_ID), api_key, endpoint, prompt, response_time, credits_used, datetime.utcnow()
+        )
     except Exception:
         pass
 
-def update_usage(api_key: str):
+def update_usage(key_data: KeyRecord):
     """Update usage statistics"""
-    try:
-        if api_key in API_KEYS_STORAGE:
-            key_data = API_KEYS_STORAGE[api_key]
-            key_data['total_requests'] += 1
-            key_data['daily_requests'] += 1
-            key_data['last_used'] = datetime.utcnow()
-            
-            # Reset daily counter if it's a new day
-            today = datetime.utcnow().date()
-            if key_data['last_reset'].date() < today:
-                key_data['daily_requests'] = 1
-                key_data['last_reset'] = datetime.utcnow()
-    except Exception:
-        pass
+    now = datetime.utcnow()
+    key_data.total_requests += 1
+    key_data.daily_requests += 1
+    key_data.last_used = now
+    
+    # Reset daily counter if it's a new day
+    today = now.toordinal()
+    if key_data.last_reset_ordinal < today:
+        key_data.daily_requests = 1
+        key_data.last_reset = now
+        key_data.last_reset_ordinal = today
+
+async def record_request(key_data: KeyRecord, api_key: str, endpoint: str, prompt: str = None, response_time: float = None, credits_used: int = 0):
+    """Update usage and log a request once its response has been sent"""
+    # Async so Starlette runs it on the event loop rather than the threadpool
+    update_usage(key_data)
+    log_request(api_key, endpoint, prompt, response_time, credits_used)
+
+def safe_endpoint(label: str):
+    """Turn unexpected errors in an endpoint into a 500 naming the service"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except HTTPException:
+                raise
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"{label} error: {str(e)}")
+        return wrapper
+    return decorator
 
 @app.get("/")
 async def root():
     """Root endpoint with API information"""
-    return {
-        "message": "Universal AI API",
-        "version": "3.1.0",
-        "status": "running",
-        "endpoints": {
-            "/image": "Generate images (2 credits)",
-            "/video": "Generate videos (2 credits)", 
-            "/voice": "Generate voice (1 credit)",
-            "/qr": "Generate QR codes (1 credit)",
-            "/num": "Number service (5 credits)",
-            "/ffinfo": "Info redirect (1 credit)",
-            "/health": "Health check",
-            "/admin/*": "Admin endpoints"
-        }
-    }
+    return Response(content=_ROOT_BODY, media_type="application/json")
 
 @app.get("/ffinfo")
+@safe_endpoint("FF Info redirect")
 async def ffinfo_redirect(
+    background_tasks: BackgroundTasks,
     uid: str = Query(..., description="User ID"),
     api_key: str = Query(..., description="Your API key")
 ):
     """FF Info redirect - COST: 1 credit"""
-    try:
-        start_time = datetime.utcnow()
-        
-        # Check if user has enough credits (1 credit needed)
-        if not check_credits(api_key, 1):
-            raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 1 credit.")
-        
-        # Validate API key
-        if api_key not in API_KEYS_STORAGE:
-            raise HTTPException(status_code=401, detail="Invalid API key")
-        
-        # Redirect to the external service with MK_DEVELOPER key
-        redirect_url = f"https://danger-info-alpha.vercel.app/accinfo?uid={uid}&key=MK_DEVELOPER"
-        
-        # Deduct credits and log request
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        use_credits(api_key, 1)
-        update_usage(api_key)
-        log_request(api_key, "/ffinfo", uid, response_time, 1)
-        
-        return RedirectResponse(redirect_url)
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"FF Info redirect error: {str(e)}")
+    start_time = time.perf_counter()
+    
+    # Validate API key and check credits (1 credit needed)
+    key_data = check_1(api_key)
+    
+    # Redirect to the external service with MK_DEVELOPER key
+    redirect_url = _FFINFO_TMPL.format(uid)
+    
+    # Deduct credits
+    key_data.credits -= 1
+    
+    # Usage stats and logging run after the response is sent
+    response_time = time.perf_counter() - start_time
+    background_tasks.add_task(record_request, key_data, api_key, "/ffinfo", uid, response_time, 1)
+    
+    return RedirectResponse(redirect_url)
 
 @app.get("/image")
+@safe_endpoint("Image generation")
 async def image_generation(
+    background_tasks: BackgroundTasks,
     prompt: str = Query(..., description="Image generation prompt"),
     width: int = Query(512, description="Image width"),
     height: int = Query(512, description="Image height"),
     api_key: str = Query(..., description="Your API key")
 ):
     """Generate images - COST: 2 credits"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
-    try:
-        # Check if user has enough credits (2 credits needed)
-        if not check_credits(api_key, 2):
-            raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 2 credits.")
-        
-        # Validate API key
-        if api_key not in API_KEYS_STORAGE:
-            raise HTTPException(status_code=401, detail="Invalid API key")
-        
-        # Generate direct image URL
-        import urllib.parse
-        encoded_prompt = urllib.parse.quote(prompt)
-        direct_image_url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?width={width}&height={height}&nologo=true"
-        
-        # Deduct credits and log request
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        use_credits(api_key, 2)
-        update_usage(api_key)
-        log_request(api_key, "/image", prompt, response_time, 2)
-        
-        return direct_image_url
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Image generation error: {str(e)}")
+    # Validate API key and check credits (2 credits needed)
+    key_data = check_2(api_key)
+    
+    # Generate direct image URL
+    encoded_prompt = _qquote(prompt)
+    direct_image_url = _IMG_TMPL.format(encoded_prompt, width, height)
+    
+    # Deduct credits
+    key_data.credits -= 2
+    
+    # Usage stats and logging run after the response is sent
+    response_time = time.perf_counter() - start_time
+    background_tasks.add_task(record_request, key_data, api_key, "/image", prompt, response_time, 2)
+    
+    return direct_image_url
 
 @app.get("/voice")
+@safe_endpoint("Voice generation")
 async def voice_generation(
+    background_tasks: BackgroundTasks,
     text: str = Query(..., description="Text to convert to speech"),
     api_key: str = Query(..., description="Your API key")
 ):
     """Generate voice from text - COST: 1 credit"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
-    try:
-        # Check if user has enough credits (1 credit needed)
-        if not check_credits(api_key, 1):
-            raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 1 credit.")
-        
-        # Validate API key
-        if api_key not in API_KEYS_STORAGE:
-            raise HTTPException(status_code=401, detail="Invalid API key")
-        
-        # Generate voice URL using TTS API
-        import urllib.parse
-        encoded_text = urllib.parse.quote(text)
-        voice_url = f"https://api.murf.ai/api/v1/speech/synthesize/stream?text={encoded_text}&voice=en-US-Standard-B&format=mp3&style=neutral&spokenPacing=medium"
-        
-        # Deduct credits and log request
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        use_credits(api_key, 1)
-        update_usage(api_key)
-        log_request(api_key, "/voice", text, response_time, 1)
-        
-        return voice_url
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Voice generation error: {str(e)}")
+    # Validate API key and check credits (1 credit needed)
+    key_data = check_1(api_key)
+    
+    # Generate voice URL using TTS API
+    encoded_text = _qquote(text)
+    voice_url = _VOICE_TMPL.format(encoded_text)
+    
+    # Deduct credits
+    key_data.credits -= 1
+    
+    # Usage stats and logging run after the response is sent
+    response_time = time.perf_counter() - start_time
+    background_tasks.add_task(record_request, key_data, api_key, "/voice", text, response_time, 1)
+    
+    return voice_url
 
 @app.get("/qr")
+@safe_endpoint("QR generation")
 async def qr_generation(
+    background_tasks: BackgroundTasks,
     data: str = Query(..., description="Data to encode in QR code"),
     api_key: str = Query(..., description="Your API key")
 ):
     """Generate QR codes - COST: 1 credit"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
-    try:
-        # Check if user has enough credits (1 credit needed)
-        if not check_credits(api_key, 1):
-            raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 1 credit.")
-        
-        # Validate API key
-        if api_key not in API_KEYS_STORAGE:
-            raise HTTPException(status_code=401, detail="Invalid API key")
-        
-        # Generate QR code URL
-        import urllib.parse
-        encoded_data = urllib.parse.quote(data)
-        qr_url = f"https://api.qrserver.com/v1/create-qr-code/?size=200x200&data={encoded_data}&format=svg"
-        
-        # Deduct credits and log request
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        use_credits(api_key, 1)
-        update_usage(api_key)
-        log_request(api_key, "/qr", data, response_time, 1)
-        
-        return qr_url
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"QR generation error: {str(e)}")
+    # Validate API key and check credits (1 credit needed)
+    key_data = check_1(api_key)
+    
+    # Generate QR code URL
+    encoded_data = _qquote(data)
+    qr_url = _QR_TMPL.format(encoded_data)
+    
+    # Deduct credits
+    key_data.credits -= 1
+    
+    # Usage stats and logging run after the response is sent
+    response_time = time.perf_counter() - start_time
+    background_tasks.add_task(record_request, key_data, api_key, "/qr", data, response_time, 1)
+    
+    return qr_url
 
 @app.get("/video")
+@safe_endpoint("Video generation")
 async def video_generation(
+    background_tasks: BackgroundTasks,
     prompt: str = Query(..., description="Video generation prompt"),
     api_key: str = Query(..., description="Your API key")
 ):
     """Video generation - COST: 2 credits"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
-    try:
-        # Check if user has enough credits (2 credits needed)
-        if not check_credits(api_key, 2):
-            raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 2 credits.")
-        
-        # Validate API key
-        if api_key not in API_KEYS_STORAGE:
-            raise HTTPException(status_code=401, detail="Invalid API key")
-        
-        # Generate video using Pollinations.ai
-        import urllib.parse
-        encoded_prompt = urllib.parse.quote(prompt)
-        video_url = f"https://image.pollinations.ai/prompt/{encoded_prompt}?width=512&height=512&nologo=true&seed=1&model=black-forest-labs/flux"
-        
-        # Deduct credits and log request
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        use_credits(api_key, 2)
-        update_usage(api_key)
-        log_request(api_key, "/video", prompt, response_time, 2)
-        
-        return video_url
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Video generation error: {str(e)}")
+    # Validate API key and check credits (2 credits needed)
+    key_data = check_2(api_key)
+    
+    # Generate video using Pollinations.ai
+    encoded_prompt = _qquote(prompt)
+    video_url = _VIDEO_TMPL.format(encoded_prompt)
+    
+    # Deduct credits
+    key_data.credits -= 2
+    
+    # Usage stats and logging run after the response is sent
+    response_time = time.perf_counter() - start_time
+    background_tasks.add_task(record_request, key_data, api_key, "/video", prompt, response_time, 2)
+    
+    return video_url
 
 @app.get("/num")
+@safe_endpoint("Number service")
 async def number_service(
+    background_tasks: BackgroundTasks,
     mobile: str = Query(..., description="Mobile number"),
     api_key: str = Query(..., description="Your API key")
 ):
     """Number service - COST: 5 credits"""
-    start_time = datetime.utcnow()
+    start_time = time.perf_counter()
     
+    # Validate API key and reserve credits (5 credits) before awaiting the upstream
+    key_data = check_5(api_key)
+    key_data.credits -= 5
+    
+    # Call number service API
+    succeeded = False
     try:
-        # Check if user has enough credits (5 credits needed)
-        if not check_credits(api_key, 5):
-            raise HTTPException(status_code=402, detail="Insufficient credits. This service costs 5 credits.")
-        
-        # Validate API key
-        if api_key not in API_KEYS_STORAGE:
-            raise HTTPException(status_code=401, detail="Invalid API key")
-        
-        # Call number service API
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            num_url = f"https://nixonsmmapi.s77134867.workers.dev/?mobile={mobile}"
-            response = await client.get(num_url)
-            response.raise_for_status()
-            num_response = response.text
-            
-        # Deduct credits and log request
-        response_time = (datetime.utcnow() - start_time).total_seconds()
-        use_credits(api_key, 5)
-        update_usage(api_key)
-        log_request(api_key, "/num", mobile, response_time, 5)
-        
-        return num_response
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Number service error: {str(e)}")
+        num_url = _NUM_TMPL.format(mobile)
+        response = await get_http_client().get(num_url)
+        response.raise_for_status()
+        num_response = response.text
+        succeeded = True
+    finally:
+        # Refund the reservation if the upstream call fails or the request is cancelled
+        if not succeeded:
+            key_data.credits += 5
+    
+    # Usage stats and logging run after the response is sent
+    response_time = time.perf_counter() - start_time
+    background_tasks.add_task(record_request, key_data, api_key, "/num", mobile, response_time, 5)
+    
+    return num_response
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
+    global _HEALTH_CACHE
     try:
-        return {
-            "status": "healthy", 
-            "timestamp": datetime.utcnow().isoformat(),
-            "api_keys_count": len(API_KEYS_STORAGE),
-            "logs_count": len(REQUEST_LOGS_STORAGE),
-            "version": "3.1.0"
-        }
+        now = time.monotonic()
+        built_at, body = _HEALTH_CACHE
+        if now - built_at > _HEALTH_TTL:
+            body = orjson.dumps({
+                "status": "healthy", 
+                "timestamp": datetime.utcnow().isoformat(),
+                "api_keys_count": len(API_KEYS_STORAGE),
+                "logs_count": len(REQUEST_LOGS_STORAGE),
+                "version": "3.1.0"
+            })
+            _HEALTH_CACHE = (now, body)
+        return Response(content=body, media_type="application/json")
     except Exception as e:
         return {
             "status": "degraded",
@@ -390,7 +503,7 @@ def handler(request, context=None):
     try:
         return app(request)
     except Exception as e:
-        return JSONResponse(
+        return OrjsonResponse(
             status_code=500,
             content={"error": f"Server error: {str(e)}"}
         )
\ No newline at end of file